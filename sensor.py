@@ -2,13 +2,14 @@
 from __future__ import annotations
 
 import logging
+import math
 import voluptuous as vol
-from collections import deque
+from array import array
+from bisect import bisect_left
 from datetime import (
     datetime, 
     timedelta
 )
-from typing import Tuple
 
 from . import (
     DOMAIN, 
@@ -50,21 +51,28 @@ from homeassistant.util.dt import utcnow
 
 _LOGGER = logging.getLogger(__name__)
 
+_DEVICE_CLASSES = frozenset(SENSOR_DEVICE_CLASSES)
+_STATE_CLASSES = frozenset(SENSOR_STATE_CLASSES)
+
 DEFAULT_ICON = "mdi:chart-line-variant"
 DEFAULT_PRECISION = 2
 DEFAULT_TIMEOUT = timedelta(minutes=1)
+DEFAULT_CAPACITY = 64
+# seconds within which a result without new data points is reused
+CACHE_INTERVAL = 1.0
 
 CONF_FILTER_WINDOW_SIZE = "window_size"
 CONF_FILTER_PRECISION = "precision"
 CONF_FILTER_TIMEOUT = "timeout"
+_POSITIVE_TIME_PERIOD = vol.All(cv.time_period, cv.positive_timedelta)
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
     {
         vol.Required(CONF_ENTITY_ID): cv.entity_domain(SENSOR_DOMAIN),
         vol.Optional(CONF_NAME): cv.string,
         vol.Optional(CONF_UNIQUE_ID): cv.string,
-        vol.Required(CONF_FILTER_WINDOW_SIZE): vol.All(cv.time_period, cv.positive_timedelta),
+        vol.Required(CONF_FILTER_WINDOW_SIZE): _POSITIVE_TIME_PERIOD,
         vol.Optional(CONF_FILTER_PRECISION, default=DEFAULT_PRECISION): vol.Coerce(int),
-        vol.Optional(CONF_FILTER_TIMEOUT, default=DEFAULT_TIMEOUT): vol.All(cv.time_period, cv.positive_timedelta)
+        vol.Optional(CONF_FILTER_TIMEOUT, default=DEFAULT_TIMEOUT): _POSITIVE_TIME_PERIOD
     }
 )
 
@@ -103,6 +111,7 @@ class SensorMovingAvg(SensorEntity):
         self._icon = None
         self._device_class = None
         self._attr_state_class = None
+        self._attrs_captured = False
 
     @callback
     def _update_filter_sensor_state_event(self, event):
@@ -115,7 +124,7 @@ class SensorMovingAvg(SensorEntity):
         """Process device state changes."""
         # start timeout on None/unknown/unavailable state
         if (new_state is None) or (new_state.state in (STATE_UNKNOWN, STATE_UNAVAILABLE)):
-            _LOGGER.debug(f"{self._name}: Received None/unknown/unavailable state, starting timeout")
+            _LOGGER.debug("%s: Received None/unknown/unavailable state, starting timeout", self._name)
             self._timeout_start = utcnow()
             return
 
@@ -123,27 +132,42 @@ class SensorMovingAvg(SensorEntity):
         if new_state.last_changed == new_state.last_updated:
             # reset possible timeout
             self._timeout_start = None
-            # get attributes from entitity
-            if self._icon is None:
-                self._icon = new_state.attributes.get(ATTR_ICON, DEFAULT_ICON)
-            if (self._device_class is None) and (new_state.attributes.get(ATTR_DEVICE_CLASS) in SENSOR_DEVICE_CLASSES):
-                self._device_class = new_state.attributes.get(ATTR_DEVICE_CLASS)
-            if (self._attr_state_class is None) and (new_state.attributes.get(SENSOR_ATTR_STATE_CLASS) in SENSOR_STATE_CLASSES):
-                self._attr_state_class = new_state.attributes.get(SENSOR_ATTR_STATE_CLASS)
-            if self._unit_of_measurement is None:
-                self._unit_of_measurement = new_state.attributes.get(ATTR_UNIT_OF_MEASUREMENT)
+            # get attributes from entitity until all of them are known
+            if not self._attrs_captured:
+                attributes = new_state.attributes
+                if self._icon is None:
+                    self._icon = attributes.get(ATTR_ICON, DEFAULT_ICON)
+                if self._device_class is None:
+                    device_class = attributes.get(ATTR_DEVICE_CLASS)
+                    if device_class in _DEVICE_CLASSES:
+                        self._device_class = device_class
+                if self._attr_state_class is None:
+                    state_class = attributes.get(SENSOR_ATTR_STATE_CLASS)
+                    if state_class in _STATE_CLASSES:
+                        self._attr_state_class = state_class
+                if self._unit_of_measurement is None:
+                    self._unit_of_measurement = attributes.get(ATTR_UNIT_OF_MEASUREMENT)
+                self._attrs_captured = not (
+                    (self._icon is None)
+                    or (self._device_class is None)
+                    or (self._attr_state_class is None)
+                    or (self._unit_of_measurement is None)
+                )
             # update moving average
-            new_val = None
             try:
                 new_val = float(new_state.state)
-                _LOGGER.debug(f"{self._name}: Updating with {new_val}")
-                self._state = self._avg.update_value(new_val, new_state.last_changed)
-                self.async_write_ha_state()
-            except ValueError:
+            except (ValueError, TypeError):
+                new_val = None
+            # nan/inf would stay in the window integral, treat them like non-numeric states
+            if (new_val is None) or not math.isfinite(new_val):
                 self._timeout_start = utcnow()
-                _LOGGER.error(f"{self._name}: State ({new_state.state}) is not a number, starting timeout")
+                _LOGGER.error("%s: State (%s) is not a finite number, starting timeout", self._name, new_state.state)
+                return
+            _LOGGER.debug("%s: Updating with %s", self._name, new_val)
+            self._state = self._avg.update_value(new_val, new_state.last_changed)
+            self.async_write_ha_state()
         else:
-            _LOGGER.debug(f"{self._name}: Not updating, last_changed != last_updated")
+            _LOGGER.debug("%s: Not updating, last_changed != last_updated", self._name)
 
     async def async_added_to_hass(self):
         """Register callbacks."""
@@ -158,15 +182,15 @@ class SensorMovingAvg(SensorEntity):
         now = utcnow()
         if self._timeout_start is not None:
             # active timeout
-            _LOGGER.debug(f"{self._name}: State is unknown/unavailable, ignoring")
+            _LOGGER.debug("%s: State is unknown/unavailable, ignoring", self._name)
             if now > self._timeout_start + self._timeout:
-                _LOGGER.debug(f"{self._name}: Timeout, resetting moving average")
+                _LOGGER.debug("%s: Timeout, resetting moving average", self._name)
                 self._state = STATE_UNAVAILABLE
                 self._avg.reset()
         else:
             # update moving average
-            self._state = self._avg.update(now)
-            _LOGGER.debug(f"{self._name}: async_update = {self._state}")
+            self._state = self._avg.update(now.timestamp())
+            _LOGGER.debug("%s: async_update = %s", self._name, self._state)
 
     @property
     def available(self):
@@ -215,80 +239,140 @@ class MovingAvg:
     def __init__(self, name, window: timedelta, precision: int) -> None:
         """Initialize moving average."""
         self._name = name
-        self._window = window
-        self._precision = precision
-        self._data = deque()
+        self._window_s = window.total_seconds()
+        # rounding of results, resolved once for the configured precision
+        if precision > 0:
+            self._finalize = lambda val: round(val, precision)
+        else:
+            self._finalize = lambda val: int(round(val, precision))
+        self._cap = DEFAULT_CAPACITY
+        self._vals = array("d", bytes(8 * self._cap))
+        self._ts = array("d", bytes(8 * self._cap))
+        # integral of value over time up to each data point, relative to a recent head
+        self._acc = array("d", bytes(8 * self._cap))
+        self.reset()
 
     def update_value(self, val: float, timestamp: datetime) -> float | int | None:
         """Update moving average with value and timestamp."""
-        self._data.append(MovingAvg._tuple(val, timestamp))
-        return self.update(timestamp)
-
-    def update(self, timestamp: datetime) -> float | int | None:
-        """Update moving average for timestamp."""
+        ts = timestamp.timestamp()
+        if self._tail != self._head:
+            last = (self._tail - 1) % self._cap
+            self._acc[self._tail] = self._acc[last] + self._vals[last] * (ts - self._ts[last])
+        else:
+            self._acc[self._tail] = 0.0
+        self._vals[self._tail] = val
+        self._ts[self._tail] = ts
+        self._tail = (self._tail + 1) % self._cap
+        self._size += 1
+        if self._tail == self._head:
+            self._grow()
+        self._cached = None
+        return self.update(ts)
+
+    def update(self, now: float) -> float | int | None:
+        """Update moving average for POSIX timestamp now."""
+        if (self._cached is not None) and (0 <= now - self._cached_now < CACHE_INTERVAL):
+            return self._cached
         ret_val = None
-        size = len(self._data)
+        size = self._size
         if size == 1:
-            ret_val = MovingAvg._value(self._data[0])
+            ret_val = self._vals[self._head]
         if size > 1:
-            # move window
-            start = timestamp - self._window
-            _LOGGER.debug(f"{self._name}: Window starts {start}")
-            removed = None
-            while ((len(self._data) > 1) and (MovingAvg._timestamp(self._data[0]) < start)):
-                removed = self._data.popleft()
-                _LOGGER.debug(f"{self._name}: Removing {MovingAvg._value(removed)},{MovingAvg._timestamp(removed)}")
-            if ((removed is not None) and (MovingAvg._timestamp(self._data[0]) > start)):
-                self._data.appendleft(MovingAvg._tuple(MovingAvg._value(removed), start))
-                _LOGGER.debug(f"{self._name}: Adding back {MovingAvg._value(removed)}")
+            # move window, buffers and indices bound to locals
+            vals = self._vals
+            ts = self._ts
+            acc = self._acc
+            cap = self._cap
+            head = self._head
+            start = now - self._window_s
+            _LOGGER.debug("%s: Window starts %s", self._name, start)
+            last = (self._tail - 1) % cap
+            if ts[head] < start:
+                head = self._first_in_window(start, last)
+                _LOGGER.debug("%s: Removing %s data points", self._name, (head - self._head) % cap)
+                if ts[head] > start:
+                    # last removed data point is still in the buffer, clip it to the window start
+                    next = head
+                    head = (head - 1) % cap
+                    acc[head] = acc[next] - vals[head] * (ts[next] - start)
+                    ts[head] = start
+                    _LOGGER.debug("%s: Adding back %s", self._name, vals[head])
+                self._evicted += self._size - (self._tail - head) % cap
+                self._head = head
+                self._size = (self._tail - head) % cap
+                if self._evicted >= cap:
+                    self._rebase()
             # compute avg
-            if len(self._data) == 1:
-                ret_val = MovingAvg._value(self._data[0])
+            if head == last:
+                acc[head] = 0.0
+                ret_val = vals[head]
             else:
-                duration = (timestamp - MovingAvg._timestamp(self._data[0])).total_seconds()
-                _LOGGER.debug(f"{self._name}: Duration is {duration}")
-                if duration > self._window.total_seconds():
-                    _LOGGER.error(f"{self._name}: Invalid duration - {duration} > {self._window.total_seconds()}")
-                ret_val = 0.0
-                prev = None
-                for cur in self._data:
-                    if prev is not None:
-                        weighted = MovingAvg._weighted(prev, MovingAvg._timestamp(cur), duration)
-                        _LOGGER.debug(f"{self._name}: Adding {weighted} - {MovingAvg._value(prev)},{MovingAvg._timestamp(prev)}, {MovingAvg._timestamp(cur)}")
-                        ret_val = ret_val + weighted
-                    prev = cur
-                if timestamp > MovingAvg._timestamp(cur):
-                    weighted = MovingAvg._weighted(cur, timestamp, duration)
-                    _LOGGER.debug(f"{self._name}: Adding tail {weighted} - {MovingAvg._value(cur)},{MovingAvg._timestamp(cur)}, {timestamp}")
-                    ret_val = ret_val + weighted
+                duration = now - ts[head]
+                _LOGGER.debug("%s: Duration is %s", self._name, duration)
+                if duration > self._window_s:
+                    _LOGGER.error("%s: Invalid duration - %s > %s", self._name, duration, self._window_s)
+                total = acc[last] - acc[head]
+                if now > ts[last]:
+                    total += vals[last] * (now - ts[last])
+                ret_val = total / duration
+                if _LOGGER.isEnabledFor(logging.DEBUG):
+                    full = _weighted_avg(vals, ts, head, self._tail, cap, now)
+                    _LOGGER.debug("%s: Running avg %s, full avg %s", self._name, ret_val, full)
         if ret_val is None:
             return None
-        elif self._precision > 0:
-            return round(ret_val, self._precision)
-        else:
-            return int(round(ret_val, self._precision))
+        ret_val = self._finalize(ret_val)
+        self._cached = ret_val
+        self._cached_now = now
+        return ret_val
 
     def reset(self) -> None:
-        """Reset window data."""
-        self._data = deque()
+        """Reset window data, keeping the allocated buffers."""
+        self._head = 0
+        self._tail = 0
+        self._size = 0
+        # data points evicted since the integral was last rebased
+        self._evicted = 0
+        # last result and the time it was computed for
+        self._cached = None
+        self._cached_now = None
+
+    def _grow(self) -> None:
+        """Double capacity of the full ring buffer."""
+        self._vals = self._vals[self._head:] + self._vals[:self._head] + array("d", bytes(8 * self._cap))
+        self._ts = self._ts[self._head:] + self._ts[:self._head] + array("d", bytes(8 * self._cap))
+        self._acc = self._acc[self._head:] + self._acc[:self._head] + array("d", bytes(8 * self._cap))
+        self._head = 0
+        self._tail = self._cap
+        self._cap = 2 * self._cap
+
+    def _rebase(self) -> None:
+        """Make integral relative to the head data point to bound its rounding error."""
+        base = self._acc[self._head]
+        for i in range(self._size):
+            self._acc[(self._head + i) % self._cap] -= base
+        self._evicted = 0
+
+    def _first_in_window(self, start: float, last: int) -> int:
+        """Index of first data point not before window start, at most last."""
+        if self._head <= last:
+            return bisect_left(self._ts, start, self._head, last)
+        if self._ts[self._cap - 1] >= start:
+            return bisect_left(self._ts, start, self._head, self._cap - 1)
+        return bisect_left(self._ts, start, 0, last)
 
     def data_points(self) -> int:
         """Number of data points currently in window."""
-        return len(self._data)
-
-    def _timestamp(tuple: Tuple[float, datetime]) -> datetime:
-        """Get timestamp from data object."""
-        return tuple[1]
+        return self._size
 
-    def _value(tuple: Tuple[float, datetime]) -> float:
-        """Get value from data object."""
-        return tuple[0]
 
-    def _tuple(val: float, timestamp: datetime) -> Tuple[float, datetime]:
-        """Get data object from value and timestamp."""
-        return [val, timestamp]
+def _weighted_avg(vals, ts, head: int, tail: int, cap: int, now: float) -> float:
+    """Recompute time weighted average over all data points of the ring buffer."""
+    last = (tail - 1) % cap
+    ret_val = 0.0
+    for i in range((tail - head) % cap - 1):
+        cur = (head + i) % cap
+        ret_val = ret_val + vals[cur] * (ts[(cur + 1) % cap] - ts[cur])
+    # the last segment is closed by now, or has no length if now is before it
+    ret_val = ret_val + vals[last] * (max(now, ts[last]) - ts[last])
+    return ret_val / (now - ts[head])
 
-    def _weighted(cur: Tuple[float, datetime], next: datetime, duration: float) -> float:
-        """Get weighted value of a data point."""
-        delta = (next - MovingAvg._timestamp(cur)).total_seconds()
-        return (MovingAvg._value(cur) * delta / duration)
@@ -0,0 +1,238 @@
+"""Tests for the moving average computation."""
+import importlib.util
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("homeassistant")
+
+# the integration directory name is not a valid module name, load it under an alias
+_ROOT = Path(__file__).resolve().parent.parent
+_spec = importlib.util.spec_from_file_location(
+    "moving_average", _ROOT / "__init__.py", submodule_search_locations=[str(_ROOT)]
+)
+_package = importlib.util.module_from_spec(_spec)
+sys.modules["moving_average"] = _package
+_spec.loader.exec_module(_package)
+
+from moving_average import sensor  # noqa: E402
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class ReferenceAvg:
+    """Time weighted average recomputed from all samples on every call."""
+
+    def __init__(self, window: timedelta, precision: int) -> None:
+        """Initialize reference average."""
+        self._window_s = window.total_seconds()
+        self._precision = precision
+        self._samples = []
+
+    def update_value(self, val: float, timestamp: datetime):
+        """Add sample, return average and number of data points."""
+        self._samples.append((val, timestamp.timestamp()))
+        return self.update(timestamp.timestamp())
+
+    def update(self, now: float):
+        """Return average and number of data points for now."""
+        if not self._samples:
+            return None, 0
+        start = now - self._window_s
+        before = [s for s in self._samples if s[1] < start]
+        inside = [s for s in self._samples if s[1] >= start]
+        if not inside:
+            return self._round(self._samples[-1][0]), 1
+        if before and inside[0][1] > start:
+            inside.insert(0, (before[-1][0], start))
+        if len(inside) == 1:
+            return self._round(inside[0][0]), 1
+        total = sum(val * (next_ts - ts) for (val, ts), (_, next_ts) in zip(inside, inside[1:]))
+        if now > inside[-1][1]:
+            total += inside[-1][0] * (now - inside[-1][1])
+        return self._round(total / (now - inside[0][1])), len(inside)
+
+    def reset(self) -> None:
+        """Drop all samples."""
+        self._samples = []
+
+    def _round(self, val: float):
+        if self._precision > 0:
+            return round(val, self._precision)
+        return int(round(val, self._precision))
+
+
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch):
+    """Compute every update, results are compared at sub-second intervals."""
+    monkeypatch.setattr(sensor, "CACHE_INTERVAL", 0.0)
+
+
+def assert_matches(avg, ref, result, expected, precision):
+    """Compare result and data points against the reference."""
+    expected_val, expected_points = expected
+    if expected_val is None:
+        assert result is None
+    else:
+        assert result == pytest.approx(expected_val, abs=1.01 * 10 ** -precision)
+    assert avg.data_points() == expected_points
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_sequences(seed):
+    """Random mix of samples, polls and resets matches the reference."""
+    rnd = random.Random(seed)
+    precision = rnd.choice([0, 1, 3])
+    window = timedelta(seconds=rnd.choice([5, 30, 300]))
+    avg = sensor.MovingAvg("test", window, precision)
+    ref = ReferenceAvg(window, precision)
+    now = START
+    for _ in range(500):
+        now += timedelta(seconds=rnd.choice([0.5, 1, 3, 7, 40, 400]) * rnd.random())
+        action = rnd.random()
+        if action < 0.5:
+            val = rnd.uniform(-1000, 1000)
+            assert_matches(avg, ref, avg.update_value(val, now), ref.update_value(val, now), precision)
+        elif action < 0.98:
+            assert_matches(avg, ref, avg.update(now.timestamp()), ref.update(now.timestamp()), precision)
+        else:
+            avg.reset()
+            ref.reset()
+            assert avg.update(now.timestamp()) is None
+            assert avg.data_points() == 0
+
+
+def test_growth_and_wraparound():
+    """Buffer grows past its initial capacity and wraps around afterwards."""
+    rnd = random.Random(0)
+    window = timedelta(seconds=1000)
+    avg = sensor.MovingAvg("test", window, 3)
+    ref = ReferenceAvg(window, 3)
+    now = START
+    max_points = 0
+    for i in range(3000):
+        # dense samples fill the buffer, sparse samples make the ring wrap
+        now += timedelta(seconds=rnd.random() * (2 if i < 1500 else 10))
+        val = rnd.uniform(0, 100)
+        assert_matches(avg, ref, avg.update_value(val, now), ref.update_value(val, now), 3)
+        max_points = max(max_points, avg.data_points())
+    assert max_points > 4 * sensor.DEFAULT_CAPACITY
+
+
+def test_eviction_after_long_gap():
+    """Polling long after the last sample keeps only the last value."""
+    window = timedelta(seconds=60)
+    avg = sensor.MovingAvg("test", window, 2)
+    ref = ReferenceAvg(window, 2)
+    now = START
+    for i in range(200):
+        now += timedelta(seconds=1)
+        ref.update_value(float(i), now)
+        avg.update_value(float(i), now)
+    now += 10 * window
+    assert_matches(avg, ref, avg.update(now.timestamp()), ref.update(now.timestamp()), 2)
+    assert avg.data_points() == 1
+    # first sample after the gap is clipped against the old value
+    now += timedelta(seconds=30)
+    assert_matches(avg, ref, avg.update_value(5.0, now), ref.update_value(5.0, now), 2)
+    now += timedelta(seconds=45)
+    assert_matches(avg, ref, avg.update(now.timestamp()), ref.update(now.timestamp()), 2)
+
+
+def test_reset():
+    """Reset drops all data points and the average starts over."""
+    window = timedelta(seconds=60)
+    avg = sensor.MovingAvg("test", window, 2)
+    now = START
+    for i in range(100):
+        now += timedelta(seconds=1)
+        avg.update_value(float(i), now)
+    avg.reset()
+    assert avg.data_points() == 0
+    assert avg.update(now.timestamp()) is None
+    now += timedelta(seconds=1)
+    assert avg.update_value(3.0, now) == 3.0
+    now += timedelta(seconds=10)
+    avg.update_value(5.0, now)
+    assert avg.update((now + timedelta(seconds=10)).timestamp()) == 4.0
+    assert avg.data_points() == 2
+
+
+def test_long_run_precision():
+    """Average stays exact after weeks of samples with large values."""
+    rnd = random.Random(0)
+    window = timedelta(seconds=30)
+    avg = sensor.MovingAvg("test", window, 6)
+    now = START
+    samples = []
+    for _ in range(35 * 24 * 360):
+        now += timedelta(seconds=10)
+        val = 1e7 + rnd.uniform(-1000, 1000)
+        samples.append((val, now))
+        avg.update_value(val, now)
+    now += timedelta(seconds=5)
+    # full recomputation from the samples still affecting the window
+    ref = ReferenceAvg(window, 6)
+    for val, timestamp in samples[-5:]:
+        ref.update_value(val, timestamp)
+    expected, points = ref.update(now.timestamp())
+    assert avg.update(now.timestamp()) == pytest.approx(expected, abs=2e-6)
+    assert avg.data_points() == points
+
+
+def test_cache(monkeypatch):
+    """Result is reused only for polls shortly after the cached one."""
+    monkeypatch.setattr(sensor, "CACHE_INTERVAL", 1.0)
+    avg = sensor.MovingAvg("test", timedelta(seconds=10), 3)
+    now = START.timestamp()
+    avg.update_value(1.0, START)
+    avg.update_value(3.0, START + timedelta(seconds=5))
+    assert avg.update(now + 9) == 1.889
+    assert avg.update(now + 9.5) == 1.889
+    assert avg.update(now + 8.5) == 1.824
+    assert avg.update(now + 10.1) == 2.02
+
+
+def test_full_recomputation_leaves_buffers_unchanged():
+    """Debug recomputation matches the average without writing to the buffers."""
+    avg = sensor.MovingAvg("test", timedelta(seconds=60), 6)
+    now = START
+    for i in range(2 * sensor.DEFAULT_CAPACITY):
+        now += timedelta(seconds=1)
+        avg.update_value(float(i % 7), now)
+    later = now.timestamp() + 3
+    result = avg.update(later)
+    vals = avg._vals.tolist()
+    ts = avg._ts.tolist()
+    full = sensor._weighted_avg(avg._vals, avg._ts, avg._head, avg._tail, avg._cap, later)
+    assert avg._vals.tolist() == vals
+    assert avg._ts.tolist() == ts
+    assert result == pytest.approx(full, abs=1e-6)
+
+
+@pytest.mark.parametrize("bad_state", ["nan", "inf", "-inf"])
+def test_non_finite_state_rejected(bad_state):
+    """Non-finite states start the timeout and do not poison the average."""
+    entity = sensor.SensorMovingAvg(
+        "test", None, "sensor.source", timedelta(minutes=1), sensor.MovingAvg("test", timedelta(seconds=60), 0)
+    )
+    entity.async_write_ha_state = lambda: None
+
+    def state(value, timestamp):
+        return SimpleNamespace(state=value, last_changed=timestamp, last_updated=timestamp, attributes={})
+
+    now = START
+    entity._update_filter_sensor_state(state("2", now))
+    now += timedelta(seconds=5)
+    entity._update_filter_sensor_state(state(bad_state, now))
+    assert entity._timeout_start is not None
+    for _ in range(100):
+        now += timedelta(seconds=5)
+        entity._update_filter_sensor_state(state("2.0", now))
+    assert entity._timeout_start is None
+    assert entity.native_value == 2
+    assert entity._avg.update((now + timedelta(seconds=1)).timestamp()) == 2